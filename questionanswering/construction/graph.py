@@ -148,6 +148,22 @@ class SemanticGraph:
         return [edge for edge in self.edges if not edge.grounded]
 
 
+def copy_with_edges(g: SemanticGraph, edges: List[Edge]):
+    """
+    Create a copy of the graph with a new edge list. As opposed to copy(g) the edges themselves are not copied,
+    so the edges that are not going to be modified can be shared between graphs.
+
+    :param g: a semantic graph
+    :param edges: list of edges for the new graph
+    :return: a new graph with the same tokens and free entities
+    >>> g = SemanticGraph([Edge(leftentityid="Q2", rightentityid="Q1")], tokens=["who"])
+    >>> new_g = copy_with_edges(g, [g.edges[0], Edge(leftentityid="Q2", rightentityid="Q3")])
+    >>> new_g, new_g.edges[0] is g.edges[0]
+    (SemanticGraph([Edge(0, Q2-None->Q1), Edge(1, Q2-None->Q3)], 0), True)
+    """
+    return SemanticGraph(edges=edges, tokens=g.tokens, free_entities=copy(g.free_entities))
+
+
 def graph_format_update(g):
     """
     Moves modifiers into separate edges.
@@ -8,7 +8,6 @@ import numpy as np
 import tqdm
 
 import fackel
-from wikidata import queries
 
 from questionanswering import config_utils, _utils
 from questionanswering.construction import sentence
@@ -89,6 +88,9 @@ def generate(path_to_model, config_file_path, seed, gpuid, experiment_tag):
     # Init the variables to store the results
     logger.debug('Testing')
     graph_queries.FREQ_THRESHOLD = config['evaluation'].get("min.relation.freq", 500)
+    graph_queries.SPARQL_WORKERS = config['evaluation'].get("sparql.workers", 1)
+    graph_queries.clear_groundings_cache()
+    graph_queries.clear_label_cache()
     global_answers = []
     avg_metrics = np.zeros(4)
 
@@ -123,7 +125,7 @@ def generate(path_to_model, config_file_path, seed, gpuid, experiment_tag):
                     valid_answer_set = True
                     if freebase_entity_set:
                         labeled_answers = {l.lower() for _, labels in
-                                           queries.get_labels_for_entities(model_answers).items() for l in labels}
+                                           graph_queries.get_labels_for_entities(model_answers).items() for l in labels}
                         valid_answer_set = len(labeled_answers & freebase_entity_set) > len(model_answers) - 1
                 j += 1
 
@@ -11,7 +11,7 @@ from entitylinking import core
 
 from questionanswering import config_utils
 from questionanswering.construction import graph, sentence
-from questionanswering.grounding import staged_generation
+from questionanswering.grounding import staged_generation, graph_queries
 
 from questionanswering.datasets import webquestions_io
 
@@ -48,6 +48,10 @@ def generate(config_file_path):
         print(f"Reusable: "
               f"{len([1 for s in previous_silver if len(s.graphs) > 0 and any([g.scores[2] > 0.9 for g in s.graphs])]) / len(previous_silver)}")
 
+    graph_queries.SPARQL_WORKERS = config['generation'].get("sparql.workers", 1)
+    graph_queries.clear_groundings_cache()
+    graph_queries.clear_label_cache()
+
     len_webquestion = len(webquestions_questions)
     start_with = 0
     if 'start.with' in config['generation']:
@@ -1,7 +1,11 @@
 import logging
 import re
 import itertools
-
+import functools
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 
 from wikidata import scheme, endpoint_access, queries
 
@@ -50,6 +54,12 @@ sparql_character_label = """
         FILTER CONTAINS(?labelright, %entitylabels)}
 """
 
+sparql_batch_subquery = """
+        {{ {select} {{ {edges} BIND ({gid} AS ?gid) }} {close} }}
+    """
+
+sparql_relation_filter = "FILTER ({variable} IN ({relations}))"
+
 sparql_restriction_time_argmax = "?m ?a [base:time ?n]. FILTER (YEAR(?n) = ?yearvalue)"
 
 sparql_filter_main_entity = """
@@ -72,6 +82,34 @@ BLACK_LIST = {"P138", "P2348", "P530", "P279", "P180", "P669", "P197"}
 CONTENT_PROPERTIES = scheme.content_properties - BLACK_LIST
 
 FREQ_THRESHOLD = 500
+# Branches of the relations that can ground an edge in the statements graph
+RELATION_BRANCHES = "vq"
+# Longer white lists are split into several queries
+MAX_RELATION_WHITELIST_SIZE = 500
+GROUNDINGS_LIMIT = 500
+
+DENOTATIONS_LIMIT = 100
+DENOTATIONS_BATCH_SIZE = 20
+VERIFICATION_BATCH_SIZE = 50
+# Graphs that can't be verified within this time (in seconds) are rejected
+VERIFICATION_TIMEOUT = 1
+MAX_BATCH_QUERY_LENGTH = 20000
+
+# Queries are executed sequentially by default, more workers should only be used with a thread-safe backend
+SPARQL_WORKERS = 1
+_sparql_pool = None
+_sparql_pool_workers = 0
+
+LABEL_CACHE_SIZE = 100000
+_label_cache = {}
+_label_cache_lock = threading.Lock()
+
+# Results of the grounding queries are shared between the questions, the least recently used ones are evicted
+# once the cache holds more than that many result rows
+GROUNDINGS_CACHE_MAX_ROWS = 200000
+_groundings_cache = OrderedDict()
+_groundings_cache_rows = 0
+_groundings_cache_lock = threading.Lock()
 
 
 def filter_relations(results, b='p', freq_threshold=0):
@@ -84,12 +122,68 @@ def filter_relations(results, b='p', freq_threshold=0):
     >>> filter_relations([{"p":"http://www.w3.org/1999/02/22-rdf-syntax-ns#type", "e2":"http://www.wikidata.org/ontology#Item"}, {"p":"http://www.wikidata.org/entity/P1429s", "e2":"http://www.wikidata.org/entity/Q76S69dc8e7d-4666-633e-0631-05ad295c891b"}])
     []
     """
-    results = [r for r in results if b not in r or
-               (r[b] in EXCEPTION_RELATIONS or
-                (r[b][:-1] in CONTENT_PROPERTIES and r[b][-1] not in endpoint_access.FILTER_RELATION_CLASSES))
-               ]
-    results = [r for r in results if b not in r or scheme.property2label[r[b][:-1]]['freq'] > freq_threshold]
-    return results
+    filtered = []
+    for r in results:
+        if b in r:
+            relation = r[b]
+            property_id = relation[:-1]
+            allowed = relation in EXCEPTION_RELATIONS or \
+                (property_id in CONTENT_PROPERTIES and relation[-1] not in endpoint_access.FILTER_RELATION_CLASSES)
+            if allowed and scheme.property2label[property_id]['freq'] > freq_threshold:
+                filtered.append(r)
+        else:
+            filtered.append(r)
+    return filtered
+
+
+@functools.lru_cache(maxsize=8)
+def get_relation_whitelist(freq_threshold, filter_relation_classes):
+    """
+    Construct the list of relations that can ground an edge. This is the server side equivalent of filter_relations.
+
+    :param freq_threshold: minimal frequency of a relation
+    :param filter_relation_classes: relation branches that are filtered out
+    :return: a tuple of relation ids with branches, the most frequent relations first
+    >>> 'P31v' in get_relation_whitelist(FREQ_THRESHOLD, endpoint_access.FILTER_RELATION_CLASSES)
+    True
+    """
+    relations = {p + b for p in CONTENT_PROPERTIES for b in RELATION_BRANCHES
+                 if b not in filter_relation_classes} | EXCEPTION_RELATIONS
+    relations = [(scheme.property2label.get(r[:-1], {}).get('freq', 0), r) for r in relations]
+    relations = tuple(r for freq, r in sorted(relations, key=lambda x: (-x[0], x[1])) if freq > freq_threshold)
+    logger.debug("Relation white list size: {}".format(len(relations)))
+    return relations
+
+
+def query_whitelisted_groundings(g: SemanticGraph, edges: List[Edge]):
+    """
+    Retrieve the groundings of the graph with the relations of the given edges restricted to the relation
+    white list in the query. The white list is put into the query in chunks of MAX_RELATION_WHITELIST_SIZE relations,
+    starting with the most frequent ones, until GROUNDINGS_LIMIT groundings are retrieved. If there is more than one
+    chunk, only the first edge is restricted, since the chunks can't be combined across edges.
+
+    :param g: graph as a SemanticGraph
+    :param edges: the ungrounded edges to restrict, should not contain class edges
+    :return: a tuple of the list of groundings or None if there was an exception and
+        the ids of the edges that were restricted in the query
+    """
+    if not edges:
+        return query_groundings(graph_to_query(g, limit=GROUNDINGS_LIMIT)), set()
+    relation_whitelist = get_relation_whitelist(FREQ_THRESHOLD, endpoint_access.FILTER_RELATION_CLASSES)
+    chunks = [relation_whitelist[i:i + MAX_RELATION_WHITELIST_SIZE]
+              for i in range(0, len(relation_whitelist), MAX_RELATION_WHITELIST_SIZE)]
+    restricted_edges = {e.edgeid for e in (edges if len(chunks) == 1 else edges[:1])}
+    logger.debug("Querying groundings with {} white list chunks.".format(len(chunks)))
+    groundings = []
+    for chunk in chunks:
+        results = query_groundings(graph_to_query(g, limit=GROUNDINGS_LIMIT,
+                                                  relation_whitelist={e: chunk for e in restricted_edges}))
+        if results is None:
+            return None, restricted_edges
+        groundings += results
+        if len(groundings) >= GROUNDINGS_LIMIT:
+            break
+    return groundings[:GROUNDINGS_LIMIT], restricted_edges
 
 
 def get_all_groundings(g: SemanticGraph):
@@ -134,22 +228,29 @@ def get_graph_groundings(g: SemanticGraph, pass_exception=False, use_wikidata=Tr
             elif any([scheme.property2label[e.relationid]["type"] == "time"
                       for e in g.edges if e.leftentityid != QUESTION_VAR]):
                 return [{'r1v': 'P31c', 'topic': "Q577"}]
+        restricted_edges = set()
         if use_wikidata:
-            groundings = endpoint_access.query_wikidata(graph_to_query(g, limit=500))
+            groundings, restricted_edges = query_whitelisted_groundings(
+                g, [e for e in ungrouded_edges if e.relationid not in sparql_class_relation])
         else:
             groundings = get_all_groundings(g)
         if groundings is None:  # If there was an exception
             return None if pass_exception else []
-        elif len(groundings) > 0:
+        # Variable names of the ungrounded edges are the same for all the groundings
+        edge_variables = [(e, f"r{e.edgeid:d}v") for e in ungrouded_edges]
+        if len(groundings) > 0:
             # keys = {b for r in groundings for b in r if b.startswith("r")}
-            for e in ungrouded_edges:
-                groundings = filter_relations(groundings, b=f"r{e.edgeid:d}v", freq_threshold=FREQ_THRESHOLD)
+            for e, v in edge_variables:
+                # Relations of the edges that were restricted in the query don't need to be filtered
+                if e.edgeid not in restricted_edges:
+                    groundings = filter_relations(groundings, b=v, freq_threshold=FREQ_THRESHOLD)
             if sentence.get_question_type(" ".join(g.tokens)) != 'temporal':
-                groundings = [r for r in groundings if all([scheme.property2label[r[f"r{e.edgeid:d}v"][:-1]]["type"] != "time"
-                                                           for e in ungrouded_edges if e.leftentityid != QUESTION_VAR])]
+                non_question_variables = [v for e, v in edge_variables if e.leftentityid != QUESTION_VAR]
+                groundings = [r for r in groundings if all(scheme.property2label[r[v][:-1]]["type"] != "time"
+                                                           for v in non_question_variables)]
         groundings = sorted(groundings,
-                            key=lambda r: sum([scheme.property2label[r[f"r{e.edgeid:d}v"][:-1]]['freq']
-                                               for e in ungrouded_edges if f"r{e.edgeid:d}v" in r]), reverse=True)
+                            key=lambda r: sum(scheme.property2label[r[v][:-1]]['freq']
+                                              for _, v in edge_variables if v in r), reverse=True)
         return groundings
     else:
         if verify_grounding(g) or not use_wikidata:
@@ -158,6 +259,43 @@ def get_graph_groundings(g: SemanticGraph, pass_exception=False, use_wikidata=Tr
             return []
 
 
+def query_groundings(query):
+    """
+    Execute a grounding query against WikiData. The raw results are cached with the query as the key,
+    so graphs of different questions and graphs that only differ in features that don't make it into the query
+    share one request. The cache is limited to GROUNDINGS_CACHE_MAX_ROWS result rows in total.
+    Failed queries are not cached.
+
+    :param query: a SPARQL query as a string
+    :return: a list of query results or None if there was an exception
+    """
+    global _groundings_cache_rows
+    with _groundings_cache_lock:
+        results = _groundings_cache.get(query)
+        if results is not None:
+            _groundings_cache.move_to_end(query)
+            return list(results)
+    results = endpoint_access.query_wikidata(query)
+    if results is None:
+        return None
+    with _groundings_cache_lock:
+        if query not in _groundings_cache:
+            _groundings_cache[query] = results
+            # Empty results are counted as one row, so that their number is limited as well
+            _groundings_cache_rows += len(results) + 1
+            while _groundings_cache_rows > GROUNDINGS_CACHE_MAX_ROWS and len(_groundings_cache) > 1:
+                _, evicted = _groundings_cache.popitem(last=False)
+                _groundings_cache_rows -= len(evicted) + 1
+    return list(results)
+
+
+def clear_groundings_cache():
+    global _groundings_cache_rows
+    with _groundings_cache_lock:
+        _groundings_cache.clear()
+        _groundings_cache_rows = 0
+
+
 def verify_grounding(g: SemanticGraph):
     """
     Verify the given graph with (partial) grounding exists in Wikidata.
@@ -169,16 +307,72 @@ def verify_grounding(g: SemanticGraph):
     """
     # if len(filter_relations(g.edges, b='kbID')) < len(g.edges):
     #     return False
-    if not sentence.get_question_type(" ".join(g.tokens)) == 'temporal' and \
-            any([scheme.property2label.get(edge.relationid, {}).get("type") == "time"
-                 for edge in g.edges if edge.leftentityid != QUESTION_VAR]):
+    if not time_relations_allowed(g):
         return False
-    verified = endpoint_access.query_wikidata(graph_to_ask(g), timeout=1)
+    verified = endpoint_access.query_wikidata(graph_to_ask(g), timeout=VERIFICATION_TIMEOUT)
     if verified == []:
         return False
     return verified
 
 
+def verify_groundings_batch(graphs):
+    """
+    Verify that the given graphs with (partial) groundings exist in Wikidata. The graphs are verified
+    in batches of VERIFICATION_BATCH_SIZE with one query per batch that returns the positions of the existing graphs.
+    A batch query gets the same VERIFICATION_TIMEOUT as a single graph: if the whole batch is verified in that time,
+    each of its graphs would have been verified on its own. Batches that can't be executed by the endpoint in time
+    are verified one graph at a time with verify_grounding.
+
+    :param graphs: an iterable of graphs
+    :return: a list of the graphs that exist in Wikidata in the input order
+    >>> verify_groundings_batch([SemanticGraph([Edge(leftentityid=QUESTION_VAR, rightentityid="Q76")]), SemanticGraph([Edge(leftentityid='Q76', rightentityid=QUESTION_VAR, relationid='P131')])])
+    [SemanticGraph([Edge(0, ?qvar-None->Q76)], 0)]
+    """
+    graphs = iter(graphs)
+    verified_graphs = []
+    batch = list(itertools.islice(graphs, VERIFICATION_BATCH_SIZE))
+    while batch:
+        batch = [g for g in batch if time_relations_allowed(g)]
+        # Graphs that need inference are verified in a separate query, so that the others are queried without it
+        with_inference = [needs_inference(g, ask=True) for g in batch]
+        verified = [False] * len(batch)
+        for inference in (False, True):
+            positions = [i for i, n in enumerate(with_inference) if n == inference]
+            for i, v in zip(positions, _verify_batch([batch[i] for i in positions])):
+                verified[i] = v
+        verified_graphs.extend(g for g, v in zip(batch, verified) if v)
+        batch = list(itertools.islice(graphs, VERIFICATION_BATCH_SIZE))
+    return verified_graphs
+
+
+def _verify_batch(batch):
+    if not batch:
+        return []
+    results = None
+    query = graphs_to_batch_query(batch, limit=1, ask=True)
+    if len(query) <= MAX_BATCH_QUERY_LENGTH:
+        results = endpoint_access.query_wikidata(query, timeout=VERIFICATION_TIMEOUT)
+    if results is None:
+        # The endpoint has rejected the batch or timed out, fall back to one query per graph
+        return map_queries(verify_grounding, batch)
+    existing = {int(r['gid']) for r in results if 'gid' in r}
+    return [gid in existing for gid in range(len(batch))]
+
+
+def time_relations_allowed(g: SemanticGraph):
+    """
+    Time relations are only allowed between entities for temporal questions.
+
+    :param g: graph as a SemanticGraph
+    :return: False if the graph has a time relation that is not allowed, True otherwise
+    >>> time_relations_allowed(SemanticGraph([Edge(leftentityid=QUESTION_VAR, rightentityid="Q76")]))
+    True
+    """
+    return sentence.get_question_type(" ".join(g.tokens)) == 'temporal' or \
+        not any(scheme.property2label.get(edge.relationid, {}).get("type") == "time"
+                for edge in g.edges if edge.leftentityid != QUESTION_VAR)
+
+
 def get_graph_denotations(g: SemanticGraph):
     """
     Convert the given graph to a WikiData query and retrieve the denotations of the graph. The results contain the
@@ -205,18 +399,179 @@ def get_graph_denotations(g: SemanticGraph):
                     post_processed.append(p)
         return post_processed
     edges = [e for e in g.edges if e.rightentityid != "Q5"]  # filter out edges with human as argument since they often fail
-    denotations = endpoint_access.query_wikidata(graph_to_query(SemanticGraph(edges=edges), limit=100))
+    denotations = endpoint_access.query_wikidata(graph_to_query(SemanticGraph(edges=edges), limit=DENOTATIONS_LIMIT))
+    return post_process_denotations(g, denotations)
+
+
+def post_process_denotations(g: SemanticGraph, denotations):
+    """
+    Extract the values of the question variable from the query results and filter out auxiliary entities.
+
+    :param g: graph as a SemanticGraph, the query results were retrieved for
+    :param denotations: query results as a list of dictionaries
+    :return: graph denotations as a list
+    >>> post_process_denotations(SemanticGraph(), [{'qvar': 'Q76'}, {'qvar': 'Q76'}, {'qvar': 'Q161-491'}])
+    ['Q76']
+    """
+    qvar_name = QUESTION_VAR[1:]
+    min_transitive_steps = None
     if denotations and all('step' in d for d in denotations):
-        min_transitive_steps = min([d['step'] for d in denotations])
-        denotations = [d for d in denotations if d['step'] == min_transitive_steps]
-    denotations = list({d[qvar_name] for d in denotations if qvar_name in d})
+        min_transitive_steps = min(d['step'] for d in denotations)
+    # Keep only the results with the minimal number of transitive steps while extracting the denotations
+    denotations = list({d[qvar_name] for d in denotations
+                        if qvar_name in d and (min_transitive_steps is None or d['step'] == min_transitive_steps)})
     if not sentence.get_question_type(" ".join(g.tokens)) == 'temporal':
         denotations = filter_auxiliary_entities_by_id(denotations)  # Filter out WikiData auxiliary variables, e.g. Q24523h-87gf8y48
     else:
-        denotations = [l for _, labels in queries.get_labels_for_entities(denotations).items() for l in labels]
+        denotations = [l for _, labels in get_labels_for_entities(denotations).items() for l in labels]
+    return denotations
+
+
+def get_graph_denotations_batch(graphs: List[SemanticGraph]):
+    """
+    Retrieve the denotations for a list of graphs. The graphs are sent to WikiData in batches of
+    DENOTATIONS_BATCH_SIZE, so that one query is issued per batch instead of one query per graph.
+    Graphs that need a special treatment (zip codes, ordering, transitive relations) and batches that
+    can't be executed by the endpoint are queried one by one with get_graph_denotations.
+
+    :param graphs: a list of grounded graphs
+    :return: a dictionary that maps the position of each graph in the input list to its denotations
+    >>> get_graph_denotations_batch([SemanticGraph([Edge(leftentityid='Q35637', relationid='P1346', rightentityid=QUESTION_VAR, qualifierentityid='2009')]), SemanticGraph([Edge(leftentityid='Q37320', relationid='P131', rightentityid='?m0Q37320'), Edge(leftentityid='?m0Q37320', relationid='P421', rightentityid=QUESTION_VAR)])])
+    {0: ['Q76'], 1: ['Q941023', 'Q28146035']}
+    """
+    denotations = {}
+    # Graphs that need inference are batched separately, so that the others are queried without it
+    batchable, batchable_with_inference, separate = [], [], []
+    for i, g in enumerate(graphs):
+        if not can_be_batched(g):
+            separate.append(i)
+        elif needs_inference(g):
+            batchable_with_inference.append(i)
+        else:
+            batchable.append(i)
+    batches = [group[start:start + DENOTATIONS_BATCH_SIZE] for group in (batchable, batchable_with_inference)
+               for start in range(0, len(group), DENOTATIONS_BATCH_SIZE)]
+    for batch in batches:
+        query = graphs_to_batch_query([graphs[i] for i in batch], limit=DENOTATIONS_LIMIT)
+        results = None
+        if len(query) <= MAX_BATCH_QUERY_LENGTH:
+            results = endpoint_access.query_wikidata(query)
+        if results is None:
+            # The endpoint has rejected the batch, fall back to one query per graph
+            logger.debug("Batch query failed, querying {} graphs separately.".format(len(batch)))
+            separate.extend(batch)
+        else:
+            batch_results = {gid: [] for gid in range(len(batch))}
+            for r in results:
+                if 'gid' in r:
+                    batch_results[int(r.pop('gid'))].append(r)
+            for gid, i in enumerate(batch):
+                denotations[i] = post_process_denotations(graphs[i], batch_results[gid])
+    separate_denotations = map_queries(get_graph_denotations, [graphs[i] for i in separate])
+    denotations.update(zip(separate, separate_denotations))
     return denotations
 
 
+def map_queries(f, items):
+    """
+    Apply a function that queries WikiData to each of the items. The calls are distributed over
+    a pool of SPARQL_WORKERS threads, since most of the time is spent waiting for the endpoint.
+    All threads share the backend installed with endpoint_access.set_backend, so SPARQL_WORKERS
+    should only be set above 1 if the backend client is thread-safe and has no per-client state such as timeouts.
+    The function should not call map_queries itself.
+
+    :param f: a function to apply
+    :param items: an iterable of items, e.g. graphs
+    :return: a list of results in the order of the items
+    >>> map_queries(len, [[1], [1, 2], []])
+    [1, 2, 0]
+    >>> map_queries(len, ([1] * i for i in range(3)))
+    [0, 1, 2]
+    """
+    global _sparql_pool, _sparql_pool_workers
+    items = list(items)
+    if SPARQL_WORKERS < 2 or len(items) < 2:
+        return [f(item) for item in items]
+    # The pool is created again if SPARQL_WORKERS has been changed since the last call
+    if _sparql_pool is None or _sparql_pool_workers != SPARQL_WORKERS:
+        if _sparql_pool is not None:
+            _sparql_pool.shutdown(wait=False)
+        _sparql_pool = ThreadPoolExecutor(max_workers=SPARQL_WORKERS)
+        _sparql_pool_workers = SPARQL_WORKERS
+    return list(_sparql_pool.map(f, items))
+
+
+def can_be_batched(g: SemanticGraph):
+    """
+    Check if the denotations of the given graph can be retrieved as a part of a batch query.
+    That is not possible if the graph has free variables apart from the question variable
+    or if its denotations require ordering or post processing of the transitive steps.
+
+    :param g: graph as a SemanticGraph
+    :return: True if the graph can go into a batch query, False otherwise
+    >>> can_be_batched(SemanticGraph([Edge(leftentityid='Q35637', relationid='P1346', rightentityid=QUESTION_VAR, qualifierentityid='2009')]))
+    True
+    >>> can_be_batched(SemanticGraph([Edge(leftentityid='Q155', rightentityid=QUESTION_VAR, relationid="P35", qualifierentityid="MAX")]))
+    False
+    >>> can_be_batched(SemanticGraph([Edge(leftentityid='Q76', rightentityid=QUESTION_VAR)]))
+    False
+    """
+    if "zip" in g.tokens and any(e.relationid == "P281" for e in g.edges):
+        return False
+    return all(edge.grounded
+               and edge.qualifierentityid not in {'MAX', 'MIN'}
+               and not (edge.simple and edge.relationid in TRANSITIVE_RELATIONS and QUESTION_VAR not in edge.nodes())
+               for edge in g.edges if edge.rightentityid != "Q5")
+
+
+def needs_inference(g: SemanticGraph, ask=False):
+    """
+    Check if the query for the given graph needs the inference clause, that is the case for graphs with class edges.
+
+    :param g: graph as a SemanticGraph
+    :param ask: if False, the edges with human as argument are ignored, since they are not part of the denotation queries
+    :return: True if the graph has class edges, False otherwise
+    >>> needs_inference(SemanticGraph([Edge(leftentityid=QUESTION_VAR, rightentityid='Q515', relationid='class')]))
+    True
+    >>> needs_inference(SemanticGraph([Edge(leftentityid=QUESTION_VAR, rightentityid='Q5', relationid='class')]))
+    False
+    >>> needs_inference(SemanticGraph([Edge(leftentityid=QUESTION_VAR, rightentityid='Q5', relationid='class')]), ask=True)
+    True
+    """
+    return any(edge.relationid == 'class' and (ask or edge.rightentityid != "Q5") for edge in g.edges)
+
+
+def graphs_to_batch_query(graphs: List[SemanticGraph], limit=DENOTATIONS_LIMIT, ask=False):
+    """
+    Convert a list of graphs to a single SPARQL query. Each graph is put into a separate sub-query
+    with its own limit and the results are marked with the position of the graph in the list (?gid).
+    The inference clause applies to the whole query, so the graphs should either all need inference or none of them.
+
+    :param graphs: a list of graphs
+    :param limit: limit on the result list size for each of the graphs
+    :param ask: if True only the positions of the graphs that exist are returned instead of the denotations
+    :return: a SPARQL query as a string
+    >>> "UNION" in graphs_to_batch_query([SemanticGraph([Edge(leftentityid='Q76', relationid='P26', rightentityid=QUESTION_VAR)]), SemanticGraph([Edge(leftentityid='Q76', relationid='P40', rightentityid=QUESTION_VAR)])])
+    True
+    """
+    variables = "?gid" if ask else f"{QUESTION_VAR} ?gid"
+    sub_queries = []
+    for gid, g in enumerate(graphs):
+        edges = [edge_to_sparql(edge, expand_transitive=not ask) for edge in g.edges
+                 if ask or edge.rightentityid != "Q5"]
+        sub_queries.append(sparql_batch_subquery.format(
+            select=queries.sparql_select.format(queryvariables=variables),
+            edges='\n'.join(edges),
+            gid=gid,
+            close=queries.sparql_close.format(limit)))
+    query = queries.sparql_prefix + queries.sparql_select.format(queryvariables=variables)
+    if any(needs_inference(g, ask=ask) for g in graphs):
+        query = queries.sparql_inference_clause + query
+    query += "{{ {} }}".format("\nUNION\n".join(sub_queries))
+    query += queries.sparql_close.format(limit * len(graphs))
+    return query
+
+
 def filter_auxiliary_entities_by_id(denotations):
     """
     A safe net method that removes all auxiliary methods from the denotations.
@@ -333,7 +688,7 @@ def edge_to_sparql(edge: graph.Edge, expand_transitive=EXPAND_TRANSITIVE_RELATIO
     return sparql_relation_template.format(triples="".join(triples))
 
 
-def graph_to_query(g: SemanticGraph, ask=False, limit=endpoint_access.GLOBAL_RESULT_LIMIT):
+def graph_to_query(g: SemanticGraph, ask=False, limit=endpoint_access.GLOBAL_RESULT_LIMIT, relation_whitelist=None):
     """
     Convert graph to a SPARQL query.
 
@@ -341,31 +696,41 @@ def graph_to_query(g: SemanticGraph, ask=False, limit=endpoint_access.GLOBAL_RES
     :param g: a graph as a dictionary with non-empty edgeSet
     :param return_var_values: if True the denotations for free variables will be returned
     :param limit: limit on the result list size
+    :param relation_whitelist: if given, a dictionary that maps edge ids to lists of relations,
+        the relations of the ungrounded edges are restricted to these lists
     :return: a SPARQL query as a string
     >>> print(graph_to_query(SemanticGraph(edges=[graph.Edge(0, "Q76", None , QUESTION_VAR)]) ))
 
+    >>> "FILTER (?r0v IN (e:P26v, e:P40v))" in graph_to_query(SemanticGraph(edges=[graph.Edge("Q76", None, QUESTION_VAR)]), relation_whitelist={0: ['P26v', 'P40v']})
+    True
     """
     variables = set()
     order_by = []
     edges = []
+    has_class_edge = False
 
     for i, edge in enumerate(g.edges):
         edges.append(edge_to_sparql(edge, expand_transitive=not ask))
         if not edge.grounded:
             variables.add(f"?r{edge.edgeid:d}v")
+            if relation_whitelist and edge.edgeid in relation_whitelist \
+                    and edge.relationid not in sparql_class_relation:
+                edges.append(sparql_relation_filter.format(
+                    variable=f"?r{edge.edgeid:d}v",
+                    relations=", ".join(f"e:{r}" for r in relation_whitelist[edge.edgeid])))
         if edge.qualifierentityid in {'MAX', 'MIN'}:
             order_by.append(f"{'DESC' if edge.qualifierentityid=='MAX' else 'ASC'}(?n{edge.edgeid:d})")
         if edge.relationid == 'iclass':
             variables.add("?topic")
-        if edge.relationid == 'iclass':
-            variables.add("?topic")
+        elif edge.relationid == 'class':
+            has_class_edge = True
         if edge.simple and edge.relationid in TRANSITIVE_RELATIONS and not ask\
                 and QUESTION_VAR not in edge.nodes():
             variables.add("?step")
 
     query = queries.sparql_prefix + (
         queries.sparql_select if not ask else queries.sparql_ask)
-    if any(edge.relationid == 'class' for edge in g.edges):
+    if has_class_edge:
         query = queries.sparql_inference_clause + query
     order_by_pattern = ""
     if len(variables - {'?step'}) == 0 and not ask:
@@ -416,6 +781,35 @@ def character_query(label, film_id, limit=3):
     return query
 
 
+def get_labels_for_entities(entities):
+    """
+    Retrieve the labels for the given entities. The labels are cached, since the same entities
+    re-appear in the denotations of many graphs. Only the entities that are not in the cache are queried.
+    The entities without labels are cached as well if the query has returned labels for the other entities,
+    an empty result could be a failed query.
+
+    :param entities: a collection of entity ids
+    :return: a dictionary that maps entity ids to lists of labels
+    >>> sorted(get_labels_for_entities(['Q76', 'Q76'])['Q76'])  # doctest: +ELLIPSIS
+    ['Barack H. Obama', ...]
+    """
+    with _label_cache_lock:
+        if len(_label_cache) > LABEL_CACHE_SIZE:
+            _label_cache.clear()
+        missing = {e for e in entities if e not in _label_cache}
+    labels = queries.get_labels_for_entities(missing) if missing else {}
+    with _label_cache_lock:
+        if labels:
+            _label_cache.update((e, labels.get(e)) for e in missing)
+        entity_labels = {e: labels.get(e, _label_cache.get(e)) for e in entities}
+    return {e: l for e, l in entity_labels.items() if l is not None}
+
+
+def clear_label_cache():
+    with _label_cache_lock:
+        _label_cache.clear()
+
+
 def label_query_results(query_results):
     """
     Extract the variable values from the query results and map them to canonical WebQuestions strings.
@@ -429,7 +823,7 @@ def label_query_results(query_results):
     """
     answers_to_label = {a for a in query_results if not a.isnumeric() and len(a) > 0}
     rest_answers = [[a] for a in query_results if a.isnumeric()]
-    answers = [[l.lower() for l in labels] for _, labels in queries.get_labels_for_entities(answers_to_label).items()]
+    answers = [[l.lower() for l in labels] for _, labels in get_labels_for_entities(answers_to_label).items()]
     answers = normalize_answer_strings(answers)
     return answers + rest_answers
 
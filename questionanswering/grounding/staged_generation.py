@@ -1,6 +1,8 @@
+import heapq
+import itertools
 import logging
+from collections import deque
 from copy import copy
-from typing import List
 
 from questionanswering.construction.graph import WithScore
 from questionanswering.construction import graph
@@ -26,26 +28,37 @@ def generate_with_gold(graph_with_scores, gold_answers):
     :param gold_answers: list of gold answers for the encoded question
     :return: a list of generated grounded graphs
     """
-    pool = [graph_with_scores]  # pool of possible parses
     if len(gold_answers) == 0 or not any(gold_answers):
-        return pool
+        return [graph_with_scores]
+    debug = logger.isEnabledFor(logging.DEBUG)
+    # Pool of possible parses as a heap ordered by the graph size and then the f-score,
+    # the counter keeps the insertion order for equal graphs
+    counter = itertools.count()
+    pool = [_pool_entry(graph_with_scores, counter)]
+    # Groundings of the graphs seen while answering this question, the same graphs are often suggested again.
+    # Unlike the query cache of graph_queries.query_groundings, it also skips the verification queries
+    # of grounded graphs and the filtering and sorting of the groundings.
+    grounding_cache = {}
     positive_graphs, negative_graphs = [], []
     iterations = 0
     while pool \
             and (max(g.scores[2] for g in positive_graphs) if len(positive_graphs) > 0 else 0.0) < MIN_F_SCORE_TO_STOP \
             and iterations < MAX_ITERATIONS:
-        g = pool.pop(0)
-        logger.debug("Pool length: {}, Graph: {}".format(len(pool), g))
+        g = heapq.heappop(pool)[-1]
+        if debug:
+            logger.debug("Pool length: {}, Graph: {}".format(len(pool), g))
         master_g_fscore = g.scores[2]
         if master_g_fscore < MIN_F_SCORE_TO_STOP:
             chosen_graphs = []
             f_i = 0
             while f_i < len(stages.ACTIONS) and not chosen_graphs:
                 suggested_graphs = stages.ACTIONS[f_i](g[0])
-                logger.debug("Suggested graphs: {}".format(suggested_graphs))
+                if debug:
+                    logger.debug("Suggested graphs: {}".format(suggested_graphs))
                 for s_g in suggested_graphs:
                     iterations += 1
-                    temp_chosen_graphs, not_chosen_graphs = ground_one_with_gold(s_g, gold_answers, master_g_fscore)
+                    temp_chosen_graphs, not_chosen_graphs = ground_one_with_gold(s_g, gold_answers, master_g_fscore,
+                                                                                 grounding_cache)
                     negative_graphs += not_chosen_graphs
                     chosen_graphs += temp_chosen_graphs
                 f_i += 1
@@ -54,15 +67,16 @@ def generate_with_gold(graph_with_scores, gold_answers):
 
             if len(chosen_graphs) > 0:
                 logger.debug("Extending the pool.")
-                pool.extend(chosen_graphs)
-                pool = sorted(pool, key=lambda x: (len(x.graph.edges), 1-x.scores[2]), reverse=False)
+                for c_g in chosen_graphs:
+                    heapq.heappush(pool, _pool_entry(c_g, counter))
 
     negative_graphs = sorted(negative_graphs, key=lambda x: (len(x.graph.edges), -len(x.graph.denotations)), reverse=True)
     positive_graphs = sorted(positive_graphs, key=lambda x: x.scores[2], reverse=True)
     return_graphs = positive_graphs + negative_graphs[:100]
-    for g in return_graphs:
-        g.graph.denotation_classes = graph_queries.get_graph_groundings(
-            stages.with_denotation_class_edge(g.graph))
+    denotation_classes = graph_queries.map_queries(graph_queries.get_graph_groundings,
+                                                   [stages.with_denotation_class_edge(g.graph) for g in return_graphs])
+    for g, classes in zip(return_graphs, denotation_classes):
+        g.graph.denotation_classes = classes
     logger.debug(f"Iterations {iterations}")
     logger.debug(f"Negative {len(negative_graphs)}")
     if iterations >= MAX_ITERATIONS:
@@ -70,20 +84,42 @@ def generate_with_gold(graph_with_scores, gold_answers):
     return return_graphs
 
 
-def ground_one_with_gold(s_g, gold_answers, min_fscore):
-    grounded_graphs = [apply_grounding(s_g, p) for p in graph_queries.get_graph_groundings(s_g)]
+def _pool_entry(g: WithScore, counter):
+    return len(g.graph.edges), 1 - g.scores[2], next(counter), g
+
+
+def _graph_signature(g: SemanticGraph):
+    return tuple(g.tokens), tuple((e.edgeid, e.leftentityid, e.relationid, e.rightentityid,
+                                   e.qualifierrelationid, e.qualifierentityid) for e in g.edges)
+
+
+def ground_one_with_gold(s_g, gold_answers, min_fscore, grounding_cache=None):
+    debug = logger.isEnabledFor(logging.DEBUG)
+    if grounding_cache is None:
+        groundings = graph_queries.get_graph_groundings(s_g)
+    else:
+        signature = _graph_signature(s_g)
+        if signature not in grounding_cache:
+            grounding_cache[signature] = graph_queries.get_graph_groundings(s_g)
+        groundings = grounding_cache[signature]
+    grounded_graphs = [apply_grounding(s_g, p) for p in groundings]
     logger.debug("Number of possible groundings: {}".format(len(grounded_graphs)))
-    logger.debug("First one: {}".format(grounded_graphs[:1]))
+    if debug:
+        logger.debug("First one: {}".format(grounded_graphs[:1]))
     i = 0
     chosen_graphs, not_chosen_graphs = [], []
     last_f1 = 0.0
+    batch_denotations = {}
     while i < len(grounded_graphs) and last_f1 < MIN_F_SCORE_TO_STOP:
+        if i not in batch_denotations:
+            # Retrieve the denotations for the next batch of graphs with a single query
+            batch = grounded_graphs[i:i + graph_queries.DENOTATIONS_BATCH_SIZE]
+            batch_denotations = {i + j: d for j, d in graph_queries.get_graph_denotations_batch(batch).items()}
         s_g = grounded_graphs[i]
-        s_g.denotations = graph_queries.get_graph_denotations(s_g)
+        s_g.denotations = batch_denotations.pop(i)
         i += 1
-        retrieved_answers = s_g.denotations
 
-        evaluation_results = evaluation.retrieval_prec_rec_f1(gold_answers, retrieved_answers)
+        evaluation_results = evaluation.retrieval_prec_rec_f1(gold_answers, s_g.denotations)
         last_f1 = evaluation_results[2]
         if last_f1 > min_fscore:
             chosen_graphs.append(WithScore(s_g, evaluation_results))
@@ -111,24 +147,28 @@ def apply_grounding(g: SemanticGraph, grounding) -> SemanticGraph:
     >>> apply_grounding(SemanticGraph(), {})
     SemanticGraph([])
     """
-    grounded = copy(g)
-    for edge in grounded.edges:
-        if f"r{edge.edgeid:d}v" in grounding:
-            if edge.relationid not in graph_queries.sparql_class_relation:
-                relation_id = grounding[f"r{edge.edgeid:d}v"][:-1]
-                branch = grounding[f"r{edge.edgeid:d}v"][-1]
-                if branch == 'q':
-                    edge.qualifierrelationid= relation_id
-                    edge.rightentityid, edge.qualifierentityid = edge.qualifierentityid, edge.rightentityid
-                else:
-                    edge.relationid = relation_id
-    return grounded
+    if not grounding:
+        return copy(g)
+    # Only the edges that receive a grounding are copied, the rest is shared with the original graph
+    edges = []
+    for edge in g.edges:
+        relation = grounding.get(f"r{edge.edgeid:d}v")
+        if relation and edge.relationid not in graph_queries.sparql_class_relation:
+            edge = copy(edge)
+            relation_id, branch = relation[:-1], relation[-1]
+            if branch == 'q':
+                edge.qualifierrelationid= relation_id
+                edge.rightentityid, edge.qualifierentityid = edge.qualifierentityid, edge.rightentityid
+            else:
+                edge.relationid = relation_id
+        edges.append(edge)
+    return graph.copy_with_edges(g, edges)
 
 
 def ground_with_model(input_graphs, s, qa_model, min_score, beam_size=10, verify_with_wikidata=True):
     """
 
-    :param input_graphs: a list of equivalent graph extensions to choose from.
+    :param input_graphs: an iterable of equivalent graph extensions to choose from.
     :param s: sentence
     :param qa_model: a model to evaluate graphs
     :param min_score: filter out graphs that receive a score lower than that from the model.
@@ -136,11 +176,14 @@ def ground_with_model(input_graphs, s, qa_model, min_score, beam_size=10, verify
     :return: a list of selected graphs with size = beam_size
     """
 
-    logger.debug("Input graphs: {}".format(len(input_graphs)))
-    logger.debug("First input one: {}".format(input_graphs[:1]))
+    debug = logger.isEnabledFor(logging.DEBUG)
+    input_groundings = graph_queries.map_queries(lambda s_g: (s_g, graph_queries.get_graph_groundings(s_g, use_wikidata=verify_with_wikidata)),
+                                                 input_graphs)
+    logger.debug("Input graphs: {}".format(len(input_groundings)))
+    if debug:
+        logger.debug("First input one: {}".format(input_groundings[:1]))
 
-    grounded_graphs = [apply_grounding(s_g, p) for s_g in input_graphs for p in graph_queries.get_graph_groundings(s_g, use_wikidata=verify_with_wikidata)]
-    grounded_graphs = filter_second_hops(grounded_graphs)
+    grounded_graphs = filter_second_hops(input_groundings)
     logger.debug("Number of possible groundings: {}".format(len(grounded_graphs)))
     if len(grounded_graphs) == 0:
         return []
@@ -154,42 +197,60 @@ def ground_with_model(input_graphs, s, qa_model, min_score, beam_size=10, verify
     if len(sentences) == 0:
         return []
     samples = V.encode_for_model(sentences, qa_model._model.__class__.__name__)
-    model_scores = qa_model.predict_batchwise(*samples).view(-1).data
+    # Convert the scores once instead of indexing the tensor for every graph
+    model_scores = qa_model.predict_batchwise(*samples).view(-1).data.tolist()
 
-    logger.debug("model_scores: {}".format(model_scores))
-    all_chosen_graphs = [WithScore(grounded_graphs[i], (0.0, 0.0, model_scores[i]))
-                         for i in range(len(grounded_graphs)) if model_scores[i] > min_score]
+    if debug:
+        logger.debug("model_scores: {}".format(model_scores))
+    all_chosen_graphs = [WithScore(s_g, (0.0, 0.0, score))
+                         for s_g, score in zip(grounded_graphs, model_scores) if score > min_score]
 
-    all_chosen_graphs = sorted(all_chosen_graphs, key=lambda x: x[1], reverse=True)
-    if len(all_chosen_graphs) > beam_size:
-        all_chosen_graphs = all_chosen_graphs[:beam_size]
+    all_chosen_graphs = heapq.nlargest(beam_size, all_chosen_graphs, key=lambda x: x[1])
     logger.debug("Number of chosen groundings: {}".format(len(all_chosen_graphs)))
     return all_chosen_graphs
 
 
-def filter_second_hops(grounded_graphs: List[SemanticGraph]):
+def filter_second_hops(input_groundings):
     """
     This methods filters out second hop relations that are already present as first hop relations. Relation direction is
-    respected.
+    respected. The graphs are filtered before the groundings are applied, so that only the remaining graphs are constructed.
 
-    :param grounded_graphs: list of grounded graphs
+    :param input_groundings: a list of ungrounded graphs paired with the lists of their groundings
     :return: filtered list of grounded graphs
     >>> g = graph.SemanticGraph(free_entities=[{"type":"NNP", "token_ids":[4], "linkings": [("Q158707", None)]}])
-    >>> filter_second_hops([apply_grounding(s_g, p) for s_g in stages.add_entity_and_relation(g, leg_length=1) + stages.add_entity_and_relation(g, leg_length=2, fixed_relations=['P26']) for p in graph_queries.get_graph_groundings(s_g)])
+    >>> filter_second_hops([(s_g, graph_queries.get_graph_groundings(s_g)) for s_g in stages.add_entity_and_relation(g, leg_length=1) + stages.add_entity_and_relation(g, leg_length=2, fixed_relations=['P26'])])
     """
 
-    first_order_relations = {r for g in grounded_graphs for e in g.edges for r in {e.relationid, e.qualifierrelationid}
-                             if any(n.startswith("Q") for n in e.nodes() if n) and graph_queries.QUESTION_VAR in e.nodes() and r}
-    grounded_graphs = [g for g in grounded_graphs
-                       if all((e.relationid not in first_order_relations and e.qualifierrelationid not in first_order_relations)
-                              or any(n.startswith("Q") for n in e.nodes() if n) for e in g.edges)]
+    # Check once for each edge if it has an entity argument, the arguments of an edge don't change with its grounding
+    edges_with_entity_flags = [[(e, any(n.startswith("Q") for n in e.nodes() if n)) for e in s_g.edges]
+                               for s_g, _ in input_groundings]
+    first_order_relations = {r for (_, groundings), edges in zip(input_groundings, edges_with_entity_flags)
+                             for e, has_entity in edges if has_entity and graph_queries.QUESTION_VAR in e.nodes()
+                             for p in groundings for r in _grounded_relations(e, p) if r}
+    grounded_graphs = [apply_grounding(s_g, p) for (s_g, groundings), edges in zip(input_groundings, edges_with_entity_flags)
+                       for p in groundings
+                       if all(has_entity or first_order_relations.isdisjoint(_grounded_relations(e, p))
+                              for e, has_entity in edges)]
     return grounded_graphs
 
 
+def _grounded_relations(edge: Edge, grounding):
+    """
+    The relation and the qualifier relation that the edge receives from the grounding, see apply_grounding.
+    """
+    relation = grounding.get(f"r{edge.edgeid:d}v")
+    if relation and edge.relationid not in graph_queries.sparql_class_relation:
+        if relation[-1] == 'q':
+            return edge.relationid, relation[:-1]
+        return relation[:-1], edge.qualifierrelationid
+    return edge.relationid, edge.qualifierrelationid
+
+
 def generate_with_model(s, qa_model, beam_size=10):
-    pool = [WithScore(s.graphs[0].graph, (0.0, 0.0, 0.0))]  # pool of possible parses
+    pool = deque([WithScore(s.graphs[0].graph, (0.0, 0.0, 0.0))])  # pool of possible parses
     generated_graphs = []
     iterations = 0
+    debug = logger.isEnabledFor(logging.DEBUG)
 
     actions = [
         lambda x: stages.add_entity_and_relation(x, leg_length=1) +
@@ -202,17 +263,19 @@ def generate_with_model(s, qa_model, beam_size=10):
 
     while pool and iterations < 100:
         iterations += 1
-        g = pool.pop(0)
-        logger.debug("Pool length: {}, Graph: {}".format(len(pool), g))
+        g = pool.popleft()
+        if debug:
+            logger.debug("Pool length: {}, Graph: {}".format(len(pool), g))
         master_score = g.scores[2]
         a_i = 0
         chosen_graphs = []
         while a_i < len(actions) and not chosen_graphs:
-            suggested_graphs = actions[a_i](g[0])
-            suggested_graphs = [s_g for s_g in suggested_graphs if sum(1 for e in s_g.edges
-                                if any(n.startswith("Q") for n in e.nodes() if n) and graph_queries.QUESTION_VAR not in e.nodes()) < 2]
-            suggested_graphs = [s_g for s_g in suggested_graphs if graph_queries.verify_grounding(s_g)]
-            logger.debug("Suggested graphs:{}, {}".format(len(suggested_graphs), suggested_graphs))
+            # The structural filter is applied lazily while the graphs are being verified
+            suggested_graphs = (s_g for s_g in actions[a_i](g[0]) if sum(1 for e in s_g.edges
+                                if any(n.startswith("Q") for n in e.nodes() if n) and graph_queries.QUESTION_VAR not in e.nodes()) < 2)
+            suggested_graphs = graph_queries.verify_groundings_batch(suggested_graphs)
+            if debug:
+                logger.debug("Suggested graphs:{}, {}".format(len(suggested_graphs), suggested_graphs))
             chosen_graphs += ground_with_model(suggested_graphs, s, qa_model, min_score=master_score,
                                                beam_size=beam_size, verify_with_wikidata=True)
             a_i += 1
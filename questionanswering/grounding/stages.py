@@ -9,8 +9,9 @@ DENOTATION_CLASS_EDGE = Edge(leftentityid=QUESTION_VAR, relationid='iclass')
 arg_relations = {"MIN": ["P582", "P585", "P577"],
                  "MAX": ["P580", "P585", "P577"]}
 year_relations = {"P585q", "P580q", "P582q"}
-argmax_markers = {"last", "latest"}
-argmin_markers = {"first", "oldest"}
+argmax_markers = frozenset({"last", "latest"})
+argmin_markers = frozenset({"first", "oldest"})
+role_markers = ("play", "voice")
 
 
 def with_denotation_class_edge(g: SemanticGraph):
@@ -54,6 +55,8 @@ def add_entity_and_relation(g: SemanticGraph, leg_length=1, fixed_relations=None
     [... SemanticGraph([Edge(0, None-None->?qvar~None->?m0Q1079), Edge(1, ?m0Q1079-None->Q1079)], 0), SemanticGraph([Edge(0, None-None->?qvar~None->?m0Q1079), Edge(1, Q1079-None->?m0Q1079)], 0)]
     >>> add_entity_and_relation(SemanticGraph(free_entities=[{'linkings':[("Q76", "Obama")], 'type':'PERSON'}]), leg_length=2)  # doctest: +ELLIPSIS
     [... SemanticGraph([Edge(0, Q76-None->?m0Q76), Edge(1, ?m0Q76-None->?qvar)], 0), SemanticGraph([Edge(0, ?m0Q76-None->Q76), Edge(1, ?m0Q76-None->?qvar)], 0)]
+    >>> add_entity_and_relation(SemanticGraph(free_entities=[{'linkings':[("Q37876", "Natalie Portman"), ("Q37876", "Portman")], 'type':'PERSON'}]))
+    [SemanticGraph([Edge(0, ?qvar-None->Q37876)], 0), SemanticGraph([Edge(0, Q37876-None->?qvar)], 0)]
     >>> add_entity_and_relation(Sentence(input_text="where is London ?").graphs[0].graph)
     [SemanticGraph([Edge(0, ?qvar-class->Q618123)], 0)]
     >>> add_entity_and_relation(SemanticGraph(free_entities=[{'linkings':[("Q76", "Obama")], 'type':'PERSON'}]), leg_length=2, fixed_relations=['P31', 'P27'])  # doctest: +ELLIPSIS
@@ -63,13 +66,21 @@ def add_entity_and_relation(g: SemanticGraph, leg_length=1, fixed_relations=None
         return []
     new_graphs = []
     # Put the common nouns to the end
-    entities_to_consider = [e for e in g.free_entities if e.get("type") not in {'NN'}] \
-                           + [e for e in g.free_entities if e.get("type") in {'NN'}]
+    entities_to_consider, common_nouns = [], []
+    for e in g.free_entities:
+        if e.get("type") == 'NN':
+            common_nouns.append(e)
+        else:
+            entities_to_consider.append(e)
+    entities_to_consider += common_nouns
+    # The tokens are the same for all entities, so the check for a character role is done only once
+    has_role_marker = any(t.lower().startswith(role_markers) for t in g.tokens)
     while entities_to_consider:
         entity = entities_to_consider.pop(0)
         if len(entity.get("linkings", [])) > 0:
-            linkings = [l for l in entity['linkings'] if l[0]]
-            for kbID, label in linkings:
+            # The same entity id can be linked more than once, keep only the first occurrence
+            linkings = list(dict.fromkeys(l[0] for l in entity['linkings'] if l[0]))
+            for kbID in linkings:
                 new_legs = []
                 if entity.get("type") == 'NN':
                     if len(g.edges) > 0:
@@ -82,7 +93,7 @@ def add_entity_and_relation(g: SemanticGraph, leg_length=1, fixed_relations=None
                     else:
                         new_legs = [(Edge(leftentityid=QUESTION_VAR, rightentityid=kbID),),
                                     (Edge(rightentityid=QUESTION_VAR, leftentityid=kbID),)]
-                    if any(t.lower().startswith("play") or t.lower().startswith("voice") for t in g.tokens):
+                    if has_role_marker:
                         new_legs.append((Edge(rightentityid=QUESTION_VAR, qualifierentityid=kbID),))
                     if leg_length > 1 and entity.get("type") == 'YEAR':
                         new_legs = []
@@ -147,10 +158,10 @@ def last_edge_numeric_constraint(g: SemanticGraph):
     if not entities_to_consider and not any(e.temporal for e in g.edges) and QUESTION_VAR in g.edges[-1].nodes():
         add_args = []
         sorting = 'MIN'
-        if len(argmin_markers & set(g.tokens)) > 0:
+        if not argmin_markers.isdisjoint(g.tokens):
             add_args = arg_relations['MIN']
             sorting = 'MIN'
-        elif len(argmax_markers & set(g.tokens)) > 0:
+        elif not argmax_markers.isdisjoint(g.tokens):
             add_args = arg_relations['MAX']
             sorting = 'MAX'
         for rel in add_args:
@@ -190,10 +201,10 @@ def add_relation(g: SemanticGraph):
     if len(g.edges) > 0 and not any(e.temporal for e in g.edges):
         add_args = []
         sorting = 'MIN'
-        if len(argmin_markers & set(g.tokens)) > 0:
+        if not argmin_markers.isdisjoint(g.tokens):
             add_args = arg_relations['MIN']
             sorting = 'MIN'
-        elif len(argmax_markers & set(g.tokens)) > 0:
+        elif not argmax_markers.isdisjoint(g.tokens):
             add_args = arg_relations['MAX']
             sorting = 'MAX'
         for rel in add_args:
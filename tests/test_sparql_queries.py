@@ -1,4 +1,5 @@
 import pytest
+from wikidata import queries
 
 from questionanswering import grounding
 from questionanswering.grounding import stages
@@ -138,6 +139,53 @@ def test_query_graph_denotations():
         assert len(result) == 0
 
 
+def test_query_graph_denotations_batch():
+    denotations = graph_queries.get_graph_denotations_batch(test_graphs_grounded + test_graphs_without_groundings)
+    assert len(denotations) == len(test_graphs_grounded) + len(test_graphs_without_groundings)
+    for i, test_graph in enumerate(test_graphs_grounded + test_graphs_without_groundings):
+        assert sorted(denotations[i]) == sorted(graph_queries.get_graph_denotations(test_graph))
+
+
+def test_verify_groundings_batch():
+    test_graphs = test_graphs_with_groundings + test_graphs_without_groundings + test_graphs_grounded
+    expected = [g for g in test_graphs if graph_queries.verify_grounding(g)]
+    assert 0 < len(expected) < len(test_graphs)
+    verified = graph_queries.verify_groundings_batch(test_graphs)
+    assert verified == expected
+
+    # Batches that are too long for the endpoint are verified one graph at a time
+    max_batch_query_length = graph_queries.MAX_BATCH_QUERY_LENGTH
+    graph_queries.MAX_BATCH_QUERY_LENGTH = 0
+    try:
+        verified = graph_queries.verify_groundings_batch(test_graphs)
+    finally:
+        graph_queries.MAX_BATCH_QUERY_LENGTH = max_batch_query_length
+    assert verified == expected
+
+
+def test_verify_groundings_batch_timeout(monkeypatch):
+    timeouts = []
+
+    def query_wikidata(query, timeout=-1, **kwargs):
+        timeouts.append(("?gid" in query, timeout))
+        # The batch queries don't finish in time, single graphs do
+        return None if "?gid" in query else True
+
+    monkeypatch.setattr(graph_queries.endpoint_access, "query_wikidata", query_wikidata)
+    verified = graph_queries.verify_groundings_batch(test_graphs_grounded)
+    assert verified == [g for g in test_graphs_grounded if graph_queries.time_relations_allowed(g)]
+    assert len([1 for batch, _ in timeouts if not batch]) == len(verified)
+    assert all(t == graph_queries.VERIFICATION_TIMEOUT for _, t in timeouts)
+
+
+def test_graphs_to_batch_query_inference():
+    with_inference = [g for g in test_graphs_grounded if graph_queries.needs_inference(g)]
+    without_inference = [g for g in test_graphs_grounded if not graph_queries.needs_inference(g)]
+    assert len(with_inference) > 0 and len(without_inference) > 0
+    assert graph_queries.graphs_to_batch_query(with_inference).startswith(queries.sparql_inference_clause)
+    assert not graph_queries.graphs_to_batch_query(without_inference).startswith(queries.sparql_inference_clause)
+
+
 def test_query_graph_topics():
     topics = []
     for test_graph in test_graphs_grounded: